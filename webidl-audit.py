@@ -5,47 +5,134 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import argparse
+import mmap
+import os
 import re
+import sqlite3
 import subprocess
 import sys
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
 # TODO Include test_interfaces.js in the example git command line.
 #      dom/tests/mochitest/general/test_interfaces.js
 
-# TODO By default, maybe run the git log command and process that, and then
-#      allow optionally specifying the log file to skip that.
-
-# TODO Making the git operations do a bunch of revisions at once surely will
-#      be faster.
-
 # Argument parsing.
 def getArgs():
     argParser = argparse.ArgumentParser(description='''
     WebIDL review audit helper.
 
-    Generate the log file with this command:
+    By default, this runs git log in the repository to find the commits to
+    audit. To audit an existing log file instead, generate it with this command:
     git log --oneline --invert-grep --grep='webidl' -- dom/webidl/
     ''',
                                         formatter_class=argparse.RawTextHelpFormatter)
     argParser.add_argument("gitRepo", help="directory of the Firefox git repository")
-    argParser.add_argument("filename", help="git log file name")
-    return argParser.parse_args()
-
-
-# Look up the given revision in the given git repository directory and return the date.
-def revisionDate(repoDirName, revision):
-    repo = Path(repoDirName).resolve()
-    dateString = subprocess.check_output(
-        ["git", "-C", str(repo), "show", "--no-patch", "--format=%cI", revision],
-        text=True
-    ).strip()
-
-    # datetime doesn't handle Z as a shorthand for the time zone, so fix it.
-    dateString = dateString.replace("Z", "+00:00")
-
-    return datetime.fromisoformat(dateString)
+    argParser.add_argument("filename", nargs="?",
+                           help="git log file name (default: run git log directly)")
+    argParser.add_argument("--cache", type=Path, default=defaultCachePath,
+                           help=f"revision metadata cache file (default: {defaultCachePath})")
+    argParser.add_argument("--no-cache", action="store_true",
+                           help="look up all revision metadata in git, without using the cache")
+    args = argParser.parse_args()
+
+    # Resolve the repository directory once here, rather than for every git command.
+    args.gitRepo = str(Path(args.gitRepo).resolve())
+
+    return args
+
+
+# Commit metadata never changes, so it is cached on disk across runs, keyed by
+# the full hash of the revision.
+defaultCachePath = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"),
+                        "webidl-audit", "revcache.sqlite")
+cacheVersion = 2
+def openCache(cachePath):
+    cachePath.parent.mkdir(parents=True, exist_ok=True)
+    cache = sqlite3.connect(cachePath)
+    if cache.execute("PRAGMA user_version").fetchone()[0] != cacheVersion:
+        cache.execute("DROP TABLE IF EXISTS rev")
+        cache.execute(f"PRAGMA user_version = {cacheVersion}")
+    cache.execute("CREATE TABLE IF NOT EXISTS rev(sha TEXT PRIMARY KEY, cdate TEXT, cemail TEXT)")
+    return cache
+
+
+# Look up the given revisions in the given git repository directory and return
+# a dictionary mapping each revision to a (date, author email) pair. The date is
+# an ISO 8601 string in UTC, so dates can be compared as strings. Running git
+# once per revision is slow, so this asks git about many revisions at once, and
+# runs the batches in parallel. Revisions found in the cache, if there is one,
+# are not looked up in git at all.
+gitBatchSize = 500
+def gitMetadata(repoDirName, revisions, cache=None):
+    # The same revision can show up more than once, if the log has duplicate
+    # entries, but there's no point in asking git about it more than once.
+    revisions = list(dict.fromkeys(revisions))
+    wanted = set(revisions)
+    revisionLengths = {len(r) for r in wanted}
+    metadata = {}
+
+    def addRecords(records):
+        for (sha, dateString, author) in records:
+            # git gives us the full hash, but the log file has abbreviated ones.
+            for n in revisionLengths:
+                if sha[:n] in wanted:
+                    metadata[sha[:n]] = (dateString, author)
+
+    if cache:
+        addRecords(cache.execute("SELECT sha, cdate, cemail FROM rev"))
+        revisions = [r for r in revisions if r not in metadata]
+
+    def showBatch(batch):
+        return subprocess.check_output(
+            ["git", "-C", repoDirName, "show", "--no-patch", "--date=iso-strict-local",
+             "--format=%H%x00%cd%x00%ce", *batch],
+            env=dict(os.environ, TZ="UTC"),
+            text=True
+        )
+
+    batches = [revisions[i:i + gitBatchSize] for i in range(0, len(revisions), gitBatchSize)]
+    newRecords = []
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for output in executor.map(showBatch, batches):
+            # Some versions of git use Z as a shorthand for UTC, so fix it.
+            output = output.replace("Z\0", "+00:00\0")
+            newRecords.extend(tuple(record.split("\0")) for record in output.splitlines())
+    addRecords(newRecords)
+
+    if cache:
+        with cache:
+            cache.executemany("INSERT OR REPLACE INTO rev VALUES (?, ?, ?)", newRecords)
+
+    return metadata
+
+
+# Run the git log command from the description in the given git repository
+# directory and return the summary lines. -z separates the entries with NUL
+# characters, so there's no ambiguity about where each one ends.
+def gitLogLines(repoDirName):
+    output = subprocess.check_output(
+        ["git", "-C", repoDirName, "log", "--invert-grep", "--grep=webidl", "-z",
+         "--format=%h %s", "--", "dom/webidl/"],
+        encoding="utf-8", errors="replace"
+    )
+    return [line for line in output.split("\0") if line]
+
+
+# Read the summary lines from the given log file. The file is memory mapped and
+# each line is decoded as it is needed, so a large log is never held in memory
+# as one big string. git log summaries have no trailing whitespace, so the lines
+# don't need stripping beyond the line ending.
+def logFileLines(filePath):
+    with filePath.open("rb") as f:
+        # mmap can't map an empty file.
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for line in iter(mm.readline, b""):
+                yield line.decode("utf-8").rstrip("\r\n")
 
 
 # There are some commits from more than a few years ago that have strange
@@ -55,185 +142,201 @@ def revisionDate(repoDirName, revision):
 currentDate = datetime.now(timezone.utc)
 # I picked 3 to dodge a specific commit from December 2021.
 numOldYears = 3
+oldCutoff = (currentDate - timedelta(days=numOldYears * 365)).isoformat(timespec="seconds")
 def dateIsOld(previousDate):
-    return currentDate - previousDate >= timedelta(days=numOldYears * 365)
+    return previousDate <= oldCutoff
 
 
 # Do the initial classification of the summary lines.
-backoutRE = "|".join(["Revert", "Backed out", "Back out", "back out",
-                      "Backout", "backout", "BACKOUT", "Backing out"])
-mergeRE = "|".join(["Merge", "merge"])
 
-backoutMergeRegexp = f"^(?P<revision>[a-z0-9]+) ({backoutRE}|{mergeRE}) "
-backoutMergePattern = re.compile(backoutMergeRegexp)
-bugPattern = re.compile(r"^(?P<revision>[a-z0-9]+)\s+(Fix for )?(Bug|bug) (?P<bugno>\d+)")
-unrecognizedPattern = re.compile("^(?P<revision>[a-z0-9]+) (?P<summary>.*)$")
+# Backouts and merges are recognized by the first word or two of the summary,
+# which must be followed by a space.
+backoutMergeWords = frozenset(["Revert", "Backout", "backout", "BACKOUT", "Merge", "merge"])
+backoutMergeWordPairs = frozenset([("Backed", "out"), ("Back", "out"), ("back", "out"),
+                                   ("Backing", "out")])
 
-bugs = []
-numReverts = 0
-numOldUnrecognized = 0
+def isBackoutOrMerge(summary):
+    words = summary.split(" ", 2)
+    if len(words) >= 2 and words[0] in backoutMergeWords:
+        return True
+    return len(words) == 3 and (words[0], words[1]) in backoutMergeWordPairs
 
-args = getArgs()
-file_path = Path(args.filename)
-with file_path.open(encoding="utf-8") as f:
-    for line in f:
-        line = line.strip()
-
-        match = bugPattern.match(line)
-        if match:
-            bugs.append((match.group("revision"), match.group("bugno"), line))
-            continue
 
-        match = backoutMergePattern.match(line)
-        if match:
-            numReverts += 1
-            continue
+# Bug lines are the most common, so they come first. Anything else with a
+# revision is classified by its summary. Revisions are abbreviated or full
+# hexadecimal git hashes, and everything we care about is ASCII.
+bugRegexp = r"\s+(?:Fix for )?(?:Bug|bug) (?P<bugno>\d+)"
+summaryRegexp = " (?P<summary>.*)$"
+linePattern = re.compile(f"^(?P<revision>[0-9a-f]{{7,40}})(?:{bugRegexp}|{summaryRegexp})",
+                         re.ASCII)
 
-        match = unrecognizedPattern.match(line)
-        if match:
-            if dateIsOld(revisionDate(args.gitRepo, match.group("revision"))):
-                numOldUnrecognized += 1
-                continue
-            else:
-                sys.stderr.write(f'Error: non-old unrecognized line: {match.group("summary")}\n')
-                exit(-1)
+bugs = []
+unrecognized = []
 
-        sys.stderr.write(f'Error: hashless line: {match.group("summary")}\n')
+# Counts of the different kinds of commits, for the final report.
+stats = Counter()
+
+args = getArgs()
+if args.filename:
+    lines = logFileLines(Path(args.filename))
+else:
+    lines = gitLogLines(args.gitRepo)
+for line in lines:
+    match = linePattern.match(line)
+    if not match:
+        # There's no match to take anything from, so report the whole line.
+        sys.stderr.write(f"Error: hashless line: {line}\n")
         exit(-1)
 
+    if match.group("bugno"):
+        bugs.append((match.group("revision"), match.group("bugno"), line))
+    elif isBackoutOrMerge(match.group("summary")):
+        stats["reverts"] += 1
+    else:
+        # Unrecognized lines are okay if they are old, but we don't know
+        # that until we've looked up the dates, so deal with them afterwards.
+        unrecognized.append((match.group("revision"), match.group("summary")))
+
 
 # In this section, we parse the list of reviewers, and check if any are DOM peers.
-reviewerPattern = re.compile(r"^(r=|sr=)?(?P<reviewer>[a-zA-Z0-9\-\.\_]+)$")
+reviewerNamePattern = re.compile(r"[\w.\-]+", re.ASCII)
 
 # This includes a lot of former peers, to try to prune out as many commits
 # as possible before we have to check the date in git. There's probably not
 # much risk of one of them suddenly r+ing things they shouldn't.
-webIDLPeersRE = "|".join([
+# Reviewer names are compared case-insensitively, so these must be lower case.
+webIDLPeers = frozenset([
     "asuth", "baku", "bent", "bholley", "billm", "bkelly", "bz", "bzbarsky",
     "echen", "edgar", "ehsan", "emilio", "farre", "hsivonen", "jst", "khuey",
-    "mccr8", "mounir", "mrbkap", "nika", "Nika", "peterv", "qdot", "saschanaz",
+    "mccr8", "mounir", "mrbkap", "nika", "peterv", "qdot", "saschanaz",
     "sefeng", "sicking", "smaug", "tschuster"])
-webIDLPeersPattern = re.compile(f"^({webIDLPeersRE})$")
 
-def parseReviewers(rString):
-    for r in rString.split(","):
-        r = r.strip(" ")
-        r = r.rstrip(" .])")
-        match = reviewerPattern.match(r)
-        if match:
-            r = match.group("reviewer")
-        else:
-            if r == "emilio DONTBUILD":
-                # Bug 1940098 has a weird DONTBUILD at the end.
-                r = "emilio"
-            else:
-                return "BAD_PARSE"
-        match = webIDLPeersPattern.match(r)
-        if match:
-            return "OK"
-    return "MISSING"
+# Strip the punctuation and any r= or sr= from around a reviewer name.
+def reviewerName(r):
+    r = r.strip(" ").rstrip(" .])")
+    for prefix in ("r=", "sr="):
+        if r.startswith(prefix):
+            return r[len(prefix):]
+    return r
 
+def parseReviewers(rString):
+    names = {reviewerName(r).lower() for r in rString.split(",")}
+    if "emilio dontbuild" in names:
+        # Bug 1940098 has a weird DONTBUILD at the end.
+        names.discard("emilio dontbuild")
+        names.add("emilio")
+    if names & webIDLPeers:
+        return "OK"
+    if all(reviewerNamePattern.fullmatch(r) for r in names):
+        return "MISSING"
+    return "BAD_PARSE"
+
+
+# Parse the reviewers of every bug before going to git. Bugs reviewed by a
+# WebIDL peer don't need anything from git, so this leaves only the revisions
+# that really need their date or author.
+bugReviewers = []
+for (revision, bugnumber, line) in bugs:
+    # The reviewers are everything after the first r=. This also finds sr=.
+    (_, rEqual, reviewerString) = line.partition("r=")
+    bugReviewers.append(parseReviewers(reviewerString) if rEqual else None)
+
+# Look up the metadata for every revision that might need it all at once, so
+# that git only has to be run a few times.
+neededRevisions = [revision for ((revision, _, _), reviewers) in zip(bugs, bugReviewers)
+                   if reviewers != "OK"]
+neededRevisions += [revision for (revision, _) in unrecognized]
+cache = None if args.no_cache else openCache(args.cache)
+metadata = gitMetadata(args.gitRepo, neededRevisions, cache)
+
+for (revision, summary) in unrecognized:
+    if dateIsOld(metadata[revision][0]):
+        stats["oldUnrecognized"] += 1
+        continue
+    sys.stderr.write(f'Error: non-old unrecognized line: {summary}\n')
+    exit(-1)
 
-rEqualPattern = re.compile(r"r\=(?P<reviewer>.*)$")
+unrecognized = []
 
-numHasPeer = 0
-numOldMissing = 0
-numOldReviewerless = 0
-numOldUnparsableReviewers = 0
-numPeerAuthored = 0
 
 bugsMissingReview = []
 
-for (revision, bugnumber, line) in bugs:
-    match = rEqualPattern.search(line)
-    if match:
-        reviewers = parseReviewers(match.group("reviewer"))
+for ((revision, bugnumber, line), reviewers) in zip(bugs, bugReviewers):
+    if reviewers:
         if reviewers == "OK":
-            numHasPeer += 1
+            stats["hasPeer"] += 1
             continue
         if reviewers == "BAD_PARSE":
-            if dateIsOld(revisionDate(args.gitRepo, revision)):
-                numOldUnparsableReviewers += 1
+            if dateIsOld(metadata[revision][0]):
+                stats["oldUnparsableReviewers"] += 1
                 continue
             else:
                 sys.stderr.write(f"Error: couldn't parse reviewers for non-old bug: {line}\n")
                 exit(-1)
         if reviewers == "MISSING":
-            if dateIsOld(revisionDate(args.gitRepo, revision)):
-                numOldMissing += 1
+            if dateIsOld(metadata[revision][0]):
+                stats["oldMissing"] += 1
                 continue
             bugsMissingReview.append((revision, bugnumber, line))
             continue
         sys.stderr.write(f"Error: unexpected parseReviewers return value {reviewers}: {line}\n")
         exit(-1)
-    elif dateIsOld(revisionDate(args.gitRepo, revision)):
-        numOldReviewerless += 1
+    elif dateIsOld(metadata[revision][0]):
+        stats["oldReviewerless"] += 1
         continue
     elif bugnumber == "1968400":
         # Bug 1968400 landed 2025-05-27, without a reviewer string.
         # smaug wrote it, so it is okay.
-        numPeerAuthored += 1
+        stats["peerAuthored"] += 1
         continue
     else:
         sys.stderr.write(f"Error: non-old bug without reviewer string: {line}\n")
         exit(-1)
 
 bugs = []
+bugReviewers = []
 
 # Next, we check the authors of patches that aren't reviewed by WebIDL peers.
 # If the author is a WebIDL peer, that's probably fine.
 # Also ignore known issues.
 
-# Return the email of the revision author, in the given repository.
-def revisionAuthor(repoDirName, revision):
-    repo = Path(repoDirName).resolve()
-    author = subprocess.check_output(
-        ["git", "-C", str(repo), "show", "--no-patch", '--format=%ce', revision],
-        text=True
-    ).strip()
-    return author
-
 # Only cover the few cases we actually need.
-webIDLPeersEmailRE = "|".join(["emilio@crisal.io", "sefeng@mozilla.com"])
-webIDLPeersEmailPattern = re.compile(f"^({webIDLPeersEmailRE})$")
-
-numKnownMissing = 0
-numUnknownMissing = 0
+# Emails are compared case-insensitively, so these must be lower case.
+webIDLPeersEmails = frozenset(["emilio@crisal.io", "sefeng@mozilla.com"])
 
 for (revision, bugnumber, line) in bugsMissingReview:
-    author = revisionAuthor(args.gitRepo, revision)
-    matches = webIDLPeersEmailPattern.match(author)
-    if matches:
-        numPeerAuthored += 1
+    author = metadata[revision][1]
+    if author.lower() in webIDLPeersEmails:
+        stats["peerAuthored"] += 1
         continue
     if bugnumber == "1966190":
         # Bug 1966190: WebIDL reviewer was removed by author because it was
         # comment-only. It was also for Glean, so not actually a web thing,
         # so not really a problem.
-        numKnownMissing += 1
+        stats["knownMissing"] += 1
         continue
     if bugnumber == "1979610":
         # Bug 1979610: This got overlooked at the time of landing due to some
         # weirdness with the Herald rule. (See bug 1986775.) It was reviewed
         # post-landing by Emilio.
-        numKnownMissing += 1
+        stats["knownMissing"] += 1
         continue
 
-    numUnknownMissing += 1
+    stats["unknownMissing"] += 1
     sys.stderr.write(f'MISSING WebIDL review for bug {bugnumber}: {line}')
 
-if numUnknownMissing > 0:
+if stats["unknownMissing"] > 0:
     sys.stderr.write(f'!!! Unknown non-old patches missing WebIDL review !!!')
     exit(-1)
 
-print(f"Patches with WebIDL peer review: {numHasPeer}")
-print(f"Patches missing WebIDL peer review, known issue: {numKnownMissing}")
-print(f"Patches missing WebIDL peer review, but authored by peer: {numPeerAuthored}")
-print(f"Old patches missing WebIDL peer review: {numOldMissing}")
-print(f"Old patches without parsable reviewer strings: {numOldUnparsableReviewers}")
-print(f"Old patches without reviewer strings: {numOldReviewerless}")
+print(f"Patches with WebIDL peer review: {stats['hasPeer']}")
+print(f"Patches missing WebIDL peer review, known issue: {stats['knownMissing']}")
+print(f"Patches missing WebIDL peer review, but authored by peer: {stats['peerAuthored']}")
+print(f"Old patches missing WebIDL peer review: {stats['oldMissing']}")
+print(f"Old patches without parsable reviewer strings: {stats['oldUnparsableReviewers']}")
+print(f"Old patches without reviewer strings: {stats['oldReviewerless']}")
 print()
-print(f"Patches that are backouts: {numReverts}")
-print(f"Old unrecognized summaries: {numOldUnrecognized}")
+print(f"Patches that are backouts: {stats['reverts']}")
+print(f"Old unrecognized summaries: {stats['oldUnrecognized']}")
 print()
 print(f"(Old means more than {numOldYears} years old.)")